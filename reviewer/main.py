@@ -1,63 +1,643 @@
+import asyncio
+import fnmatch
+import functools
+import hashlib
 import os
+import pathlib
+import posixpath
+import re
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
 import requests
 import openai
+import orjson
+import tiktoken
+from requests.adapters import HTTPAdapter
+from tenacity import retry, retry_if_exception_type, stop_after_attempt, wait_exponential_jitter
+from urllib.parse import parse_qs, urlparse
+from urllib3.util.retry import Retry
 
 # --- OpenAI Client Setup ---
-client = openai.OpenAI(api_key=os.environ["OPENAI_API_KEY"])
+# One shared client for the whole run; the aiohttp transport holds up much
+# better than the default httpx one when many reviews are in flight.
+# Retries are handled by tenacity around each review call instead of the SDK.
+# Created on first use, so importing this module doesn't need an API key.
+@functools.lru_cache(maxsize=None)
+def openai_client():
+    return openai.AsyncOpenAI(
+        api_key=os.environ["OPENAI_API_KEY"],
+        http_client=openai.DefaultAioHttpClient(),
+        max_retries=0,
+    )
+
+
+# Errors worth retrying with backoff; anything else fails the batch right away.
+TRANSIENT_OPENAI_ERRORS = (
+    openai.RateLimitError,
+    openai.APITimeoutError,
+    openai.APIConnectionError,
+    openai.InternalServerError,
+)
+
+MODEL = "gpt-4o"
+
+SEVERITY_ORDER = {"critical": 4, "high": 3, "medium": 2, "low": 1}
+
+# Issues below this severity are never requested: the schema's severity enum
+# and the instructions only admit the allowed levels, so the model doesn't
+# spend output tokens on suggestions that would be thrown away.
+MIN_SEVERITY = os.environ.get("REVIEW_MIN_SEVERITY", "low").lower()
+MIN_LEVEL = SEVERITY_ORDER.get(MIN_SEVERITY, 2)
+ALLOWED_SEVERITIES = [name for name, level in SEVERITY_ORDER.items() if level >= MIN_LEVEL]
+
+# Every instruction lives in the system message, and only the patches in the user
+# message vary. OpenAI only caches prompt prefixes of 1024+ tokens, which this
+# preamble alone doesn't reach, so don't count on it being billed as cached.
+SYSTEM_PREAMBLE = """You are a precise, helpful code reviewer, acting as a senior software engineer reviewing a pull request.
+
+The user message contains the diff patches for one or more files in this pull request.
+
+For each file, identify up to 3 specific lines that may need improvement.
+Only report issues of severity """ + ALLOWED_SEVERITIES[-1] + """ or higher.
+
+Respond with a JSON object in this format, with one entry per file:
+{
+  "files": [
+    {
+      "filename": "<filename>",
+      "suggestions": [
+        { "line": <line_number>, "severity": "<""" + "|".join(ALLOWED_SEVERITIES) + """>", "comment": "<comment>" },
+        ...
+      ]
+    },
+    ...
+  ]
+}
+
+Only suggest valid and useful inline comments. Use line numbers from the "new" version of each file.
+"""
+
+# Upper bound on in-flight OpenAI requests, to stay clear of 429s. Raise or
+# lower it to match the account's rate limits.
+MAX_CONCURRENT_REVIEWS = int(os.environ.get("REVIEW_CONCURRENCY", 8))
+
+# Account rate limits the reviews are paced against (defaults: gpt-4o, tier 1),
+# and the output tokens a file's suggestions are expected to take.
+OPENAI_RPM = int(os.environ.get("OPENAI_RPM", 500))
+OPENAI_TPM = int(os.environ.get("OPENAI_TPM", 30000))
+EST_OUTPUT_TOKENS_PER_FILE = 150
+
+# Stream completions so reading can stop as soon as the JSON reply is complete.
+STREAM = True
+
+# Opt-in OpenAI Batch API for non-interactive runs (REVIEW_BATCH=1 or --batch):
+# half the price and a separate rate-limit pool, but results can take hours.
+USE_BATCH_API = os.environ.get("REVIEW_BATCH") == "1" or "--batch" in sys.argv
+BATCH_POLL_INITIAL_SECONDS = 10
+BATCH_POLL_MAX_SECONDS = 300
+# Give up (and cancel the job) well before GitHub kills the workflow at 6 hours,
+# rather than waiting out the Batch API's 24-hour completion window.
+BATCH_MAX_WAIT_SECONDS = 5 * 60 * 60
+
+# Token budget for the patches packed into one request. Smaller batches keep
+# the model focused and leave more requests to run in parallel.
+MAX_BATCH_TOKENS = 8000
+
+# Patches above this many tokens (lockfile churn, generated code) are not
+# worth a review and are skipped before any API call.
+MAX_PATCH_TOKENS = 30000
+
+# Generated or vendored files that never get a useful review. Matched against
+# the file's basename, so they apply in any directory of a monorepo.
+SKIP_FILES = [
+    "*.lock",
+    "*.snap",
+    "*.pb.go",
+    "*.min.js",
+    "package-lock.json",
+]
+SKIP_RE = re.compile("|".join(fnmatch.translate(p) for p in SKIP_FILES))
+
+# Start line and line count of the "new" side in a hunk header like "@@ -10,7 +12,9 @@".
+HUNK_RE = re.compile(rb'@@ -\d+(?:,\d+)? \+(\d+)(?:,(\d+))?')
+
+# The only characters that matter when tracking nesting in a streamed JSON reply.
+JSON_STRUCTURE_RE = re.compile(r'[\\"{}\[\]]')
+
+# --- Review Cache ---
+# Suggestions are stored on disk keyed by a hash of everything sent to the
+# model, so reruns on an unchanged patch skip the OpenAI call entirely.
+CACHE_DIR = pathlib.Path(".review_cache")
+CACHE_TTL_SECONDS = 14 * 24 * 60 * 60
 
 # --- GitHub Setup ---
-GITHUB_TOKEN = os.environ["GITHUB_TOKEN"]
-REPO = os.environ["GITHUB_REPO"]  # e.g., "user/repo"
-PR_NUMBER = os.environ["GITHUB_PR_NUMBER"]
+# Read with .get so the module can be imported (e.g. by the tests) without
+# them; main() checks they are all set before doing anything.
+GITHUB_TOKEN = os.environ.get("GITHUB_TOKEN")
+REPO = os.environ.get("GITHUB_REPO")  # e.g., "user/repo"
+PR_NUMBER = os.environ.get("GITHUB_PR_NUMBER")
 
 headers = {
     "Authorization": f"token {GITHUB_TOKEN}",
     "Accept": "application/vnd.github.v3+json",
 }
 
+# Shared session so every GitHub call reuses the same keep-alive connection.
+# Transient 429/5xx responses are retried with exponential backoff.
+session = requests.Session()
+session.headers.update(headers)
+session.mount("https://", HTTPAdapter(
+    pool_connections=10,
+    pool_maxsize=20,
+    max_retries=Retry(
+        total=5,
+        backoff_factor=0.5,
+        status_forcelist=[429, 500, 502, 503, 504],
+    ),
+))
+
+# The files endpoint defaults to 30 per page; 100 is the maximum.
+FILES_PER_PAGE = 100
+
+# Remaining pages of a large PR are fetched in parallel on the shared session.
+MAX_CONCURRENT_PAGE_FETCHES = 5
+
+# GitHub's secondary rate limits punish bursts of concurrent writes.
+MAX_CONCURRENT_COMMENTS = 5
+
+# Longest a rate-limited review post waits for a retry; a primary limit can
+# take up to an hour to reset, which isn't worth holding the job for.
+MAX_RATE_LIMIT_WAIT_SECONDS = 300
+
+
+def pr_files_cache_path():
+    return CACHE_DIR / f"pr-files-{REPO.replace('/', '_')}-{PR_NUMBER}.json"
+
+
+def load_cached_pr_files():
+    path = pr_files_cache_path()
+    try:
+        return orjson.loads(path.read_bytes())
+    except (OSError, ValueError):
+        return None
+
 
 def fetch_pr_files():
+    """
+    Fetches every file in the PR. The first page tells us (via the Link header)
+    how many pages there are; the rest are fetched concurrently.
+
+    Each page is cached on disk with its ETag and always revalidated with
+    If-None-Match; a 304 reuses the cached page and doesn't count against the
+    rate limit.
+    """
+
+    cached = load_cached_pr_files()
+    cached_pages = cached["pages"] if cached is not None else []
     url = f"https://api.github.com/repos/{REPO}/pulls/{PR_NUMBER}/files"
-    r = requests.get(url, headers=headers)
-    return r.json()
 
+    def fetch_page(page):
+        cached_page = cached_pages[page - 1] if page <= len(cached_pages) else None
+        page_headers = {"If-None-Match": cached_page["etag"]} if cached_page and cached_page["etag"] else {}
 
-def review_file_with_openai(filename, patch):
-    prompt = f"""
-You are a senior software engineer reviewing a pull request.
+        r = session.get(url, params={"per_page": FILES_PER_PAGE, "page": page}, headers=page_headers)
+        if r.status_code == 304:
+            return r, cached_page
 
-Here is the diff patch for `{filename}`:
-{patch}
+        r.raise_for_status()
+        return r, {"etag": r.headers.get("ETag"), "files": orjson.loads(r.content)}
 
-Please identify up to 3 specific lines that may need improvement.
+    r, first_page = fetch_page(1)
 
-Respond with a list of objects in this format:
-[
-  {{ "line": <line_number>, "comment": "<comment>" }},
-  ...
-]
+    last_page = 1
+    if "last" in r.links:
+        query = parse_qs(urlparse(r.links["last"]["url"]).query)
+        last_page = int(query["page"][0])
+    elif r.status_code == 304:
+        last_page = len(cached_pages)
 
-Only suggest valid and useful inline comments. Use line numbers from the "new" version of the file.
-"""
+    with ThreadPoolExecutor(max_workers=MAX_CONCURRENT_PAGE_FETCHES) as executor:
+        rest = list(executor.map(fetch_page, range(2, last_page + 1)))
+    pages = [first_page] + [page for _, page in rest]
+
+    try:
+        CACHE_DIR.mkdir(exist_ok=True)
+        pr_files_cache_path().write_bytes(orjson.dumps({"pages": pages}))
+    except OSError as e:
+        print(f"⚠️ Could not write PR files cache: {e}")
+
+    return [file for page in pages for file in page["files"]]
+
+
+@functools.lru_cache(maxsize=None)
+def token_encoder():
+    # tiktoken downloads its BPE tables on first use; if that fails, estimate
+    # instead of failing the run before any review is posted.
+    try:
+        return tiktoken.encoding_for_model(MODEL)
+    except (OSError, ValueError) as e:
+        print(f"⚠️ Could not load the tokenizer, estimating token counts instead: {e}")
+        return None
+
+
+def count_tokens(text):
+    encoder = token_encoder()
+    if encoder is None:
+        return len(text) // 4  # roughly four characters per token
+    return len(encoder.encode(text, disallowed_special=()))
+
+
+@functools.lru_cache(maxsize=None)
+def preamble_tokens():
+    # Only the rate limiter needs this, so the Batch API path never counts it.
+    return count_tokens(SYSTEM_PREAMBLE)
+
+
+def should_skip_file(filename):
+    return SKIP_RE.match(posixpath.basename(filename)) is not None
+
+
+def cache_key(prompt):
+    return hashlib.sha256(f"{MODEL}|{SYSTEM_PREAMBLE}|{prompt}".encode()).hexdigest()
+
+
+def load_cached_review(key):
+    path = CACHE_DIR / key
+    try:
+        if time.time() - path.stat().st_mtime > CACHE_TTL_SECONDS:
+            path.unlink()
+            return None
+        return orjson.loads(path.read_bytes())
+    except (OSError, ValueError):
+        return None
+
+
+def prune_review_cache():
+    """
+    Deletes expired cache entries, including ones no lookup will reach again
+    (files dropped from the PR, old prompts), so the saved cache doesn't grow forever.
+    """
+
+    cutoff = time.time() - CACHE_TTL_SECONDS
+    try:
+        for path in CACHE_DIR.iterdir():
+            if path.stat().st_mtime < cutoff:
+                path.unlink()
+    except OSError:
+        pass
+
+
+def store_cached_review(key, suggestions):
+    try:
+        CACHE_DIR.mkdir(exist_ok=True)
+        (CACHE_DIR / key).write_bytes(orjson.dumps(suggestions))
+    except OSError as e:
+        print(f"⚠️ Could not write review cache: {e}")
+
+
+# Structured output schema: the API guarantees the reply parses and matches it.
+REVIEW_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "files": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {
+                    "filename": {"type": "string"},
+                    "suggestions": {
+                        "type": "array",
+                        "items": {
+                            "type": "object",
+                            "properties": {
+                                "line": {"type": "integer"},
+                                "severity": {
+                                    "type": "string",
+                                    "enum": ALLOWED_SEVERITIES,
+                                },
+                                "comment": {"type": "string"},
+                            },
+                            "required": ["line", "severity", "comment"],
+                            "additionalProperties": False,
+                        },
+                    },
+                },
+                "required": ["filename", "suggestions"],
+                "additionalProperties": False,
+            },
+        },
+    },
+    "required": ["files"],
+    "additionalProperties": False,
+}
+
+
+RESPONSE_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {"name": "review", "schema": REVIEW_SCHEMA, "strict": True},
+}
+
+
+class RateLimiter:
+    """
+    Token buckets for requests and tokens per minute. Callers wait here until
+    both buckets can cover the request, so concurrent reviews are spread out
+    instead of bursting into 429s and their backoff.
+    """
+
+    def __init__(self, rpm, tpm):
+        self.rpm = rpm
+        self.tpm = tpm
+        self._req_tokens = float(rpm)
+        self._tok_tokens = float(tpm)
+        self._last = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        elapsed = now - self._last
+        self._last = now
+        self._req_tokens = min(self.rpm, self._req_tokens + elapsed * self.rpm / 60)
+        self._tok_tokens = min(self.tpm, self._tok_tokens + elapsed * self.tpm / 60)
+
+    async def acquire(self, est_tokens):
+        # A request bigger than the whole bucket still has to go through eventually.
+        est_tokens = min(est_tokens, self.tpm)
+
+        async with self._lock:
+            while True:
+                self._refill()
+                if self._req_tokens >= 1 and self._tok_tokens >= est_tokens:
+                    self._req_tokens -= 1
+                    self._tok_tokens -= est_tokens
+                    return
+
+                wait = max(
+                    (1 - self._req_tokens) * 60 / self.rpm,
+                    (est_tokens - self._tok_tokens) * 60 / self.tpm,
+                )
+                await asyncio.sleep(wait)
+
+
+rate_limiter = RateLimiter(OPENAI_RPM, OPENAI_TPM)
+
+
+def file_cache_key(file):
+    return cache_key(f"{file['filename']}|{file['patch']}")
+
+
+def make_batches(files, token_counts):
+    """
+    Packs files into batches whose combined patch tokens stay under
+    MAX_BATCH_TOKENS, so the shared instructions are sent once per batch
+    instead of once per file. A single oversized file gets its own batch.
+    """
+
+    batches = []
+    current = []
+    current_tokens = 0
+
+    for file in files:
+        tokens = token_counts[file["filename"]]
+
+        if current and current_tokens + tokens > MAX_BATCH_TOKENS:
+            batches.append(current)
+            current = []
+            current_tokens = 0
+
+        current.append(file)
+        current_tokens += tokens
+
+    if current:
+        batches.append(current)
+
+    return batches
+
+
+def build_batch_prompt(files_batch):
+    # Assembled in one join: patches can be large, and repeated concatenation
+    # would copy them over and over.
+    parts = ["Review the following files:\n"]
+    for index, file in enumerate(files_batch, 1):
+        parts.append(f"\n### FILE {index}: {file['filename']}\n```diff\n{file['patch']}\n```\n")
+    return "".join(parts)
+
+
+async def read_streamed_reply(stream):
+    """
+    Collects a streamed completion and returns (content, refusal). Stops reading
+    as soon as the top-level JSON value closes instead of waiting for the stream
+    to finish.
+    """
 
-    response = client.chat.completions.create(
-        model="gpt-4o",
+    parts = []
+    refusal = []
+    depth = 0
+    in_string = False
+    escaped_at_start = False  # previous chunk ended on a backslash inside a string
+
+    async for chunk in stream:
+        if not chunk.choices:
+            continue
+
+        delta = chunk.choices[0].delta
+        if delta.refusal:
+            refusal.append(delta.refusal)
+        if not delta.content:
+            continue
+
+        content = delta.content
+        parts.append(content)
+
+        # Index of the character escaped by a preceding backslash, if any.
+        escaped = 0 if escaped_at_start else -1
+        escaped_at_start = False
+
+        for match in JSON_STRUCTURE_RE.finditer(content):
+            index = match.start()
+            if index == escaped:
+                continue
+
+            char = match.group()
+            if in_string:
+                if char == "\\":
+                    escaped = index + 1
+                    escaped_at_start = escaped == len(content)
+                elif char == '"':
+                    in_string = False
+            elif char == '"':
+                in_string = True
+            elif char in "{[":
+                depth += 1
+            elif char in "}]":
+                depth -= 1
+                if depth == 0:
+                    parts[-1] = content[:index + 1]
+                    await stream.close()
+                    return "".join(parts), "".join(refusal)
+
+    return "".join(parts), "".join(refusal)
+
+
+def build_review_request(files_batch):
+    return dict(
+        model=MODEL,
         messages=[
-            {"role": "system", "content": "You are a precise, helpful code reviewer."},
-            {"role": "user", "content": prompt}
+            {"role": "system", "content": SYSTEM_PREAMBLE},
+            {"role": "user", "content": build_batch_prompt(files_batch)}
         ],
         temperature=0.3,
+        response_format=RESPONSE_FORMAT,
     )
 
+
+def parse_review(files_batch, content, refusal):
+    """
+    Turns the model's reply for a batch into {filename: suggestions} and caches
+    each file's result. Files missing from the reply are left out of both.
+    """
+
+    filenames = ", ".join(file["filename"] for file in files_batch)
+
+    if refusal:
+        print(f"⚠️ Model declined to review {filenames}: {refusal}")
+        return {}
+
+    # Structured output still yields no JSON on a refusal or a reply cut off
+    # at the token limit; never fall back to evaluating the text.
     try:
-        return eval(response.choices[0].message.content.strip())
-    except Exception:
-        return []
+        review = orjson.loads(content)
+    except (ValueError, TypeError):
+        print(f"⚠️ Could not parse review for {filenames}")
+        return {}
+
+    by_file = {entry["filename"]: entry["suggestions"] for entry in review["files"]}
+
+    results = {}
+    for file in files_batch:
+        if file["filename"] not in by_file:
+            # Not cached, so the next run asks again instead of trusting an omission.
+            print(f"⚠️ Review reply has no entry for {file['filename']}")
+            continue
+
+        suggestions = by_file[file["filename"]]
+        store_cached_review(file_cache_key(file), suggestions)
+        results[file["filename"]] = suggestions
+
+    return results
+
+
+# Shared backoff policy for every OpenAI call (the client's own retries are off).
+retry_transient = retry(
+    retry=retry_if_exception_type(TRANSIENT_OPENAI_ERRORS),
+    wait=wait_exponential_jitter(initial=1, max=30),
+    stop=stop_after_attempt(5),
+    reraise=True,
+)
+
+
+@retry_transient
+async def call_openai(method, *args, **kwargs):
+    return await method(*args, **kwargs)
+
 
+@retry_transient
+async def review_batch_with_openai(files_batch, est_tokens):
+    request = build_review_request(files_batch)
+    await rate_limiter.acquire(est_tokens)
 
-def build_review_comments(files):
+    try:
+        if STREAM:
+            stream = await openai_client().chat.completions.create(**request, stream=True)
+            content, refusal = await read_streamed_reply(stream)
+        else:
+            response = await openai_client().chat.completions.create(**request)
+            message = response.choices[0].message
+            content, refusal = message.content, message.refusal
+    except openai.BadRequestError as e:
+        # Retrying the same request won't help.
+        filenames = ", ".join(file["filename"] for file in files_batch)
+        print(f"⚠️ OpenAI rejected the review request for {filenames}: {e}")
+        return {}
+
+    return parse_review(files_batch, content, refusal)
+
+
+async def review_batches_with_batch_api(batches):
+    """
+    Submits every batch as one job through the OpenAI Batch API, which costs half
+    as much and has its own rate limits, then polls until it finishes. Suited to
+    scheduled runs where nobody is waiting on the review.
+
+    Returns one entry per batch, like asyncio.gather(..., return_exceptions=True):
+    the {filename: suggestions} dict, or the exception that batch failed with.
+    """
+
+    lines = [
+        orjson.dumps({
+            "custom_id": str(index),
+            "method": "POST",
+            "url": "/v1/chat/completions",
+            "body": build_review_request(files_batch),
+        })
+        for index, files_batch in enumerate(batches)
+    ]
+    input_file = await call_openai(
+        openai_client().files.create,
+        file=("review_requests.jsonl", b"\n".join(lines)),
+        purpose="batch",
+    )
+    job = await call_openai(
+        openai_client().batches.create,
+        input_file_id=input_file.id,
+        endpoint="/v1/chat/completions",
+        completion_window="24h",
+    )
+    print(f"⏳ Submitted batch job {job.id} with {len(batches)} requests...")
+
+    deadline = time.monotonic() + BATCH_MAX_WAIT_SECONDS
+    delay = BATCH_POLL_INITIAL_SECONDS
+    while job.status not in ("completed", "failed", "expired", "cancelled"):
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            # Nobody would collect its results, and the next run submits a fresh job.
+            await call_openai(openai_client().batches.cancel, job.id)
+            error = RuntimeError(f"batch job {job.id} still {job.status} after {BATCH_MAX_WAIT_SECONDS}s; cancelled")
+            return [error] * len(batches)
+
+        await asyncio.sleep(min(delay, remaining))
+        delay = min(delay * 2, BATCH_POLL_MAX_SECONDS)
+        job = await call_openai(openai_client().batches.retrieve, job.id)
+
+    results = [RuntimeError(f"batch job {job.id} {job.status} without a result")] * len(batches)
+
+    # Successful requests land in the output file, failed ones in the error file.
+    for file_id in (job.output_file_id, job.error_file_id):
+        if not file_id:
+            continue
+
+        output = await call_openai(openai_client().files.content, file_id)
+        for line in output.text.splitlines():
+            record = orjson.loads(line)
+            index = int(record["custom_id"])
+            response = record.get("response")
+
+            if record.get("error") or not response or response["status_code"] != 200:
+                error = record.get("error") or (response and response["body"].get("error")) or response
+                results[index] = RuntimeError(f"batch request failed: {error}")
+                continue
+
+            message = response["body"]["choices"][0]["message"]
+            results[index] = parse_review(batches[index], message.get("content"), message.get("refusal"))
+
+    return results
+
+
+async def build_review_comments(files):
     review_comments = []
 
+    reviewable = []
     for file in files:
         filename = file["filename"]
         patch = file.get("patch")
@@ -65,60 +645,180 @@ def build_review_comments(files):
         if not patch:
             continue  # Skip binary files or deletions
 
-        suggestions = review_file_with_openai(filename, patch)
+        if should_skip_file(filename):
+            print(f"⏭️ Skipping {filename} (matches skip list)")
+            continue
+
+        # GitHub patches start with a hunk header, so every added line follows a newline.
+        if "\n+" not in patch:
+            print(f"⏭️ Skipping {filename} (no added lines)")
+            continue
+
+        reviewable.append(file)
+    files = reviewable
+
+    suggestions_by_file = {}
+    pending = []
+    token_counts = {}
+    # Files with byte-identical patches are reviewed once; the others reuse
+    # the result. Maps the reviewed file's name to the files sharing its patch.
+    duplicates = {}
+    seen = {}
+    for file in files:
+        cached = load_cached_review(file_cache_key(file))
+        if cached is not None:
+            suggestions_by_file[file["filename"]] = cached
+            continue
+
+        # Counted only on a cache miss, so a fully cached run never loads the tokenizer.
+        n_tokens = count_tokens(file["patch"])
+        if n_tokens > MAX_PATCH_TOKENS:
+            print(f"⏭️ Skipping {file['filename']} ({n_tokens} tokens, over {MAX_PATCH_TOKENS})")
+            continue
+        token_counts[file["filename"]] = n_tokens
+
+        patch_hash = hashlib.sha256(file["patch"].encode()).hexdigest()
+        if patch_hash in seen:
+            duplicates[seen[patch_hash]].append(file)
+        else:
+            seen[patch_hash] = file["filename"]
+            duplicates[file["filename"]] = []
+            pending.append(file)
+
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_REVIEWS)
+
+    async def review_with_limit(files_batch):
+        est_tokens = preamble_tokens() + sum(
+            token_counts[file["filename"]] + EST_OUTPUT_TOKENS_PER_FILE for file in files_batch
+        )
+        async with semaphore:
+            return await review_batch_with_openai(files_batch, est_tokens)
+
+    # Longest-first: the slowest reviews start right away and the small ones
+    # fill the remaining slots, instead of a big patch being queued last.
+    pending.sort(key=lambda file: len(file["patch"]), reverse=True)
+    batches = make_batches(pending, token_counts)
+    batches.sort(key=lambda files_batch: sum(len(file["patch"]) for file in files_batch), reverse=True)
+    if USE_BATCH_API and batches:
+        try:
+            results = await review_batches_with_batch_api(batches)
+        except openai.OpenAIError as e:
+            # Report it per batch, the same way the concurrent path does.
+            results = [e] * len(batches)
+    else:
+        results = await asyncio.gather(
+            *(review_with_limit(files_batch) for files_batch in batches),
+            return_exceptions=True,
+        )
+
+    for files_batch, result in zip(batches, results):
+        if isinstance(result, Exception):
+            filenames = ", ".join(file["filename"] for file in files_batch)
+            print(f"⚠️ Review failed for {filenames}: {result}")
+            continue
+
+        suggestions_by_file.update(result)
+
+        for filename, suggestions in result.items():
+            for duplicate in duplicates[filename]:
+                suggestions_by_file[duplicate["filename"]] = suggestions
+                store_cached_review(file_cache_key(duplicate), suggestions)
+
+    for file in files:
+        filename = file["filename"]
+        suggestions = suggestions_by_file.get(filename, [])
+        if not suggestions:
+            continue
+
+        targets = {suggestion.get("line") for suggestion in suggestions}
+        pos_map = build_position_map(file["patch"], targets)
 
         for suggestion in suggestions:
             line = suggestion.get("line")
             comment = suggestion.get("comment")
 
-            if line and comment:
-                review_comments.append({
-                    "path": filename,
-                    "position": find_position_in_diff(file, line),
-                    "body": comment
-                })
+            if not (line and comment):
+                continue
+
+            position = pos_map.get(line)
+            if position is None:
+                # GitHub rejects the whole review if any comment isn't on the diff.
+                print(f"⚠️ Skipping comment on {filename}:{line}, which isn't an added line.")
+                continue
+
+            review_comments.append({
+                "path": filename,
+                "position": position,
+                "body": comment
+            })
 
     return review_comments
 
 
-def find_position_in_diff(file, target_line):
+def build_position_map(patch, targets=None):
     """
     GitHub API requires 'position' — the line offset in the diff, not the actual line number.
-    This function maps a line number in the 'new' file to a position in the patch.
+    This function maps every added line number in the 'new' file to its position in the patch,
+    in a single pass, so each suggestion is a dict lookup.
+
+    If `targets` (the new-file line numbers we need) is given, hunks whose new-side
+    range holds none of them are skipped without scanning their lines.
     """
 
-    patch_lines = file.get("patch", "").splitlines()
+    # Walk the raw bytes line by line instead of building a list of str lines.
+    # Splitting on b"\n" only also matches how GitHub counts positions, where
+    # str.splitlines would break on \r, \x0c, \u2028 and friends inside a line.
+    data = patch.encode()
+    end = len(data)
+    mapping = {}
     position = 0
-    current_line = None
+    current_line = 0
+    i = 0
 
-    new_line_num = None
-    for line in patch_lines:
+    while i < end:
+        j = data.find(b"\n", i)
+        if j == -1:
+            j = end
         position += 1
+        c = data[i:i + 1]
 
-        if line.startswith("@@"):
+        if c == b"@" and data.startswith(b"@@", i):
             # Extract new line start
-            hunk_header = line.split("@@")[1]
-            try:
-                old_info, new_info = hunk_header.strip().split(" ")
-                start_line = int(new_info.split(",")[0].replace("+", ""))
-                current_line = start_line - 1
-            except Exception:
-                continue
-        elif line.startswith("+") and not line.startswith("+++"):
+            match = HUNK_RE.match(data, i, j)
+            if match:
+                start = int(match.group(1))
+                count = int(match.group(2) or 1)
+                current_line = start - 1
+
+                if targets is not None and not any(start <= t < start + count for t in targets):
+                    next_hunk = data.find(b"\n@@", j)
+                    if next_hunk == -1:
+                        break
+                    # Keep counting positions across the skipped body.
+                    position += data.count(b"\n", j, next_hunk)
+                    i = next_hunk + 1
+                    continue
+        elif c == b"+":
+            # The API's patch has no file headers, so "+++" is just an added line.
             current_line += 1
-            if current_line == target_line:
-                return position
-
-        elif not line.startswith("-"):
+            mapping[current_line] = position
+        elif c != b"-" and c != b"\\":
+            # Anything but removed lines and "\ No newline at end of file" markers
             current_line += 1
 
-    return None  # line not found in diff
+        i = j + 1
+
+    return mapping
+
+
+def post_json(url, payload):
+    return session.post(url, data=orjson.dumps(payload), headers={"Content-Type": "application/json"})
 
 
 def post_inline_review(comments):
     if not comments:
         print("No inline comments to post.")
-        return
+        return True
 
     url = f"https://api.github.com/repos/{REPO}/pulls/{PR_NUMBER}/reviews"
     payload = {
@@ -127,23 +827,126 @@ def post_inline_review(comments):
         "comments": comments
     }
 
-    r = requests.post(url, headers=headers, json=payload)
+    r = post_json(url, payload)
+
+    if r.status_code == 403 and is_rate_limited(r):
+        wait = rate_limit_wait(r)
+        if wait <= MAX_RATE_LIMIT_WAIT_SECONDS:
+            print(f"⏳ GitHub rate limit hit; retrying the review in {wait}s...")
+            time.sleep(wait)
+            r = post_json(url, payload)
+        else:
+            print(f"⏳ GitHub rate limit resets in {wait}s; not waiting that long.")
 
     if r.status_code == 200:
         print("✅ Inline review comments posted.")
-    else:
-        print(f"❌ Failed to post review: {r.status_code}\n{r.text}")
+        return True
 
+    print(f"❌ Failed to post review: {r.status_code}\n{r.text}")
+
+    if r.status_code == 403:
+        if is_rate_limited(r):
+            print("❌ Rate limited by GitHub; giving up on this run.")
+        else:
+            print(f"❌ GitHub refused to post the review. {describe_missing_permission()}")
+        # Individual comments would be refused the same way, so don't fall back.
+        sys.exit(1)
+
+    return False
+
+
+def is_rate_limited(r):
+    # GitHub answers both primary and secondary rate limits with a 403.
+    return r.headers.get("X-RateLimit-Remaining") == "0" or "rate limit" in r.text.lower()
+
+
+def rate_limit_wait(r):
+    # Secondary limits say how long to wait; primary ones only give the reset time.
+    if "Retry-After" in r.headers:
+        return int(r.headers["Retry-After"])
+    if "X-RateLimit-Reset" in r.headers:
+        return max(0, int(r.headers["X-RateLimit-Reset"]) - int(time.time())) + 1
+    return 60
+
+
+def describe_missing_permission():
+    """
+    A 403 on the reviews endpoint that isn't a rate limit almost always means the
+    token can't write to pull requests. Work out which kind of token it is and
+    return how to fix it.
+    """
+
+    r = session.get(f"https://api.github.com/repos/{REPO}")
+    scopes = r.headers.get("X-OAuth-Scopes")
+
+    if scopes is None:
+        # Only classic PATs report scopes; this is GITHUB_TOKEN or a fine-grained token.
+        return (
+            "Give the token pull request write access, e.g. `permissions: pull-requests: write` "
+            "in the workflow. Note GITHUB_TOKEN is always read-only for PRs from forks."
+        )
+
+    return f"The token's scopes are [{scopes}]; a classic PAT needs `repo` (or `public_repo`)."
+
+
+def fetch_pr_head_sha():
+    url = f"https://api.github.com/repos/{REPO}/pulls/{PR_NUMBER}"
+    r = session.get(url)
+    return r.json()["head"]["sha"]
+
+
+def post_individual_comments(comments):
+    """
+    Fallback when the batched review is rejected: posts each comment on its own,
+    so one comment GitHub refuses doesn't take the rest down with it.
+    """
+
+    url = f"https://api.github.com/repos/{REPO}/pulls/{PR_NUMBER}/comments"
+    commit_id = fetch_pr_head_sha()
+
+    def post_one_comment(comment):
+        try:
+            r = post_json(url, {**comment, "commit_id": commit_id})
+        except requests.RequestException as e:
+            return False, str(e)
+        return r.status_code == 201, r.status_code
+
+    # Threads share the session's connection pool; the pool size keeps us
+    # under GitHub's secondary rate limits for concurrent writes.
+    with ThreadPoolExecutor(max_workers=MAX_CONCURRENT_COMMENTS) as executor:
+        results = list(executor.map(post_one_comment, comments))
+
+    success_count = sum(1 for ok, _ in results if ok)
+    failed_count = len(results) - success_count
+    print(f"✅ Posted {success_count} individual comments ({failed_count} failed).")
+
+
+async def main_async():
+    prune_review_cache()
 
-def main():
     print("🔍 Fetching PR files...")
     files = fetch_pr_files()
 
     print("🧠 Generating review comments with OpenAI...")
-    review_comments = build_review_comments(files)
+    try:
+        review_comments = await build_review_comments(files)
+    finally:
+        await openai_client().close()
 
     print("📝 Posting comments to GitHub...")
-    post_inline_review(review_comments)
+    if not post_inline_review(review_comments):
+        print("↩️ Falling back to posting comments individually...")
+        post_individual_comments(review_comments)
+
+
+def main():
+    required = ("OPENAI_API_KEY", "GITHUB_TOKEN", "GITHUB_REPO", "GITHUB_PR_NUMBER")
+    missing = [name for name in required if not os.environ.get(name)]
+    if missing:
+        print(f"❌ Missing environment variables: {', '.join(missing)}")
+        sys.exit(1)
+
+    asyncio.run(main_async())
 
 
 if __name__ == "__main__":
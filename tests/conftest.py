@@ -0,0 +1,5 @@
+import pathlib
+import sys
+
+# reviewer/ is a script directory, not a package; make main.py importable.
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent.parent / "reviewer"))
@@ -0,0 +1,98 @@
+import random
+import re
+
+from main import build_position_map
+
+
+def reference_position_map(patch):
+    """Straightforward line-by-line version build_position_map must agree with."""
+
+    mapping = {}
+    current_line = 0
+    for position, line in enumerate(patch.split("\n"), 1):
+        if line.startswith("@@"):
+            current_line = int(re.match(r"@@ -\S+ \+(\d+)", line).group(1)) - 1
+        elif line.startswith("+"):
+            current_line += 1
+            mapping[current_line] = position
+        elif not line.startswith(("-", "\\")):
+            current_line += 1
+    return mapping
+
+
+def random_patch(rng):
+    hunks = []
+    old_line = new_line = 1
+    for _ in range(rng.randint(1, 6)):
+        old_line += rng.randint(0, 20)
+        new_line += rng.randint(0, 20)
+        body = []
+        old_count = new_count = 0
+        for _ in range(rng.randint(0, 12)):
+            kind = rng.choice(" -+")
+            text = rng.choice(["x", "", "++i;", "+", "--", "\\", "a\rb", "\x0c"])
+            body.append(kind + text)
+            if kind != "+":
+                old_count += 1
+            if kind != "-":
+                new_count += 1
+            if rng.random() < 0.1:
+                body.append("\\ No newline at end of file")
+        hunks.append(f"@@ -{old_line},{old_count} +{new_line},{new_count} @@ def f():")
+        hunks.extend(body)
+        old_line += old_count
+        new_line += new_count
+    return "\n".join(hunks)
+
+
+def test_maps_added_lines_to_positions():
+    patch = "@@ -1,3 +1,4 @@\n a\n-b\n+c\n+d\n e"
+    assert build_position_map(patch) == {2: 4, 3: 5}
+
+
+def test_added_lines_starting_with_plus_plus_plus():
+    # The API's patch has no file headers, so "+++" is content.
+    assert build_position_map("@@ -1,2 +1,3 @@\n a\n+++i;\n+b") == {2: 3, 3: 4}
+
+
+def test_no_newline_marker_is_not_a_line():
+    patch = "@@ -1 +1,2 @@\n-a\n\\ No newline at end of file\n+a\n+b"
+    assert build_position_map(patch) == {1: 4, 2: 5}
+
+
+def test_positions_continue_across_hunks():
+    patch = "@@ -3,2 +2,0 @@\n-x\n-y\n@@ -10,1 +9,2 @@\n c\n+d"
+    assert build_position_map(patch) == {10: 6}
+
+
+def test_only_newlines_split_lines():
+    # \r, \x0c and friends are part of the line, as they are for GitHub.
+    patch = "@@ -1 +1,3 @@\n a\r\n+b\x0cc\n+d e\n+f"
+    assert build_position_map(patch) == {2: 3, 3: 4, 4: 5}
+
+
+def test_matches_reference_on_random_patches():
+    rng = random.Random(0)
+    for _ in range(2000):
+        patch = random_patch(rng)
+        assert build_position_map(patch) == reference_position_map(patch), patch
+
+
+def test_skipped_hunks_still_count_positions():
+    patch = "@@ -1,2 +1,3 @@\n a\n+b\n c\n@@ -20,1 +21,2 @@\n d\n+e"
+    assert build_position_map(patch, {22}) == {22: 7}
+
+
+def test_no_targets_skips_every_hunk():
+    assert build_position_map("@@ -1,1 +1,2 @@\n a\n+b", set()) == {}
+
+
+def test_targets_agree_with_full_map_on_random_patches():
+    rng = random.Random(1)
+    for _ in range(2000):
+        patch = random_patch(rng)
+        full = build_position_map(patch)
+        targets = set(rng.sample(range(1, 200), rng.randint(1, 5)))
+        with_targets = build_position_map(patch, targets)
+        for target in targets:
+            assert with_targets.get(target) == full.get(target), (patch, target)
@@ -0,0 +1,87 @@
+import asyncio
+from types import SimpleNamespace
+
+from main import read_streamed_reply
+
+
+class FakeStream:
+    def __init__(self, contents, refusals=()):
+        self.chunks = [
+            SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=content, refusal=None))])
+            for content in contents
+        ]
+        self.chunks += [
+            SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=None, refusal=refusal))])
+            for refusal in refusals
+        ]
+        self.read = 0
+        self.closed = False
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self.read == len(self.chunks):
+            raise StopAsyncIteration
+        self.read += 1
+        return self.chunks[self.read - 1]
+
+    async def close(self):
+        self.closed = True
+
+
+def read(contents, refusals=()):
+    stream = FakeStream(contents, refusals)
+    content, refusal = asyncio.run(read_streamed_reply(stream))
+    return content, refusal, stream
+
+
+def test_stops_once_the_json_closes():
+    content, refusal, stream = read(['{"files": [', "]}", "\n", "never read"])
+    assert (content, refusal) == ('{"files": []}', "")
+    assert stream.closed
+    assert stream.read == 2
+
+
+def test_brackets_inside_strings_are_ignored():
+    reply = '{"comment": "use } or ] and { [ here"}'
+    content, _, stream = read([reply[:14], reply[14:], "tail"])
+    assert content == reply
+    assert stream.read == 2
+
+
+def test_escaped_quote_split_across_chunks():
+    content, _, _ = read(['{"a": "x\\', '"}"}', "tail"])
+    assert content == '{"a": "x\\"}"}'
+
+
+def test_escaped_backslash_split_across_chunks():
+    # The second backslash is escaped, so the quote after it ends the string.
+    content, _, _ = read(['{"a": "x\\', '\\"}', "tail"])
+    assert content == '{"a": "x\\\\"}'
+
+
+def test_every_split_point():
+    reply = '{"files": [{"filename": "a\\\\b.py", "comment": "say \\"}\\" {[ok]}"}]}'
+    for split in range(1, len(reply)):
+        content, _, _ = read([reply[:split], reply[split:], "tail"])
+        assert content == reply, split
+
+
+def test_one_character_chunks():
+    reply = '{"a": ["\\\\", "\\"", "}"]}'
+    content, _, _ = read(list(reply) + ["tail"])
+    assert content == reply
+
+
+def test_collects_a_refusal():
+    content, refusal, stream = read([], ["I can't ", "help with that."])
+    assert (content, refusal) == ("", "I can't help with that.")
+    assert not stream.closed
+
+
+def test_chunks_without_choices_are_skipped():
+    stream = FakeStream(['{"a": 1}'])
+    stream.chunks.insert(0, SimpleNamespace(choices=[]))
+    content, _ = asyncio.run(read_streamed_reply(stream))
+    assert content == '{"a": 1}'